@@ -317,10 +317,20 @@ panel_hide() {
   sleep 0.15
 }
 
+spawn_detached() {
+  # Start a long-lived desktop process in its own session, so it is not in
+  # our process group (toolbar_api kills that group if a request hangs).
+  if command -v setsid >/dev/null 2>&1; then
+    as_user setsid nohup "$@"
+  else
+    as_user nohup "$@"
+  fi
+}
+
 panel_show() {
   # Start panel if not running
   if ! pgrep -u "$USER_NAME" xfce4-panel >/dev/null 2>&1; then
-    as_user nohup xfce4-panel >/tmp/xfce4-panel.log 2>&1 &
+    spawn_detached xfce4-panel >/tmp/xfce4-panel.log 2>&1 &
     disown || true
     sleep 0.25
   fi
@@ -332,17 +342,15 @@ desktop_reload() {
     as_user xfdesktop --reload >/dev/null 2>&1 || {
       pkill -u "$USER_NAME" xfdesktop >/dev/null 2>&1 || true
       sleep 0.15
-      as_user nohup xfdesktop >/tmp/xfdesktop.log 2>&1 &
+      spawn_detached xfdesktop >/tmp/xfdesktop.log 2>&1 &
       disown || true
     }
   fi
   sleep 0.25
 }
 
-verify_and_fix_once() {
-  local want="$1"
-  local menu winmenu icons panel_running
-
+read_state() {
+  # Sets menu/winmenu/icons/panel_running in the caller's scope.
   menu="$(xfget xfce4-desktop /desktop-menu/show 2>/dev/null || echo "unknown")"
   winmenu="$(xfget xfce4-desktop /windowlist-menu/show 2>/dev/null || echo "unknown")"
   icons="$(xfget xfce4-desktop /desktop-icons/style 2>/dev/null || echo "unknown")"
@@ -352,10 +360,39 @@ verify_and_fix_once() {
   else
     panel_running="no"
   fi
+}
 
-  if [[ "$want" == "on" ]]; then
+state_matches() {
+  # Uses the variables set by read_state.
+  if [[ "$1" == "on" ]]; then
     # Expect: menu=false, winmenu=false, icons=0, panel_running=no
-    if [[ "$menu" != "false" || "$winmenu" != "false" || "$icons" != "0" || "$panel_running" != "no" ]]; then
+    [[ "$menu" == "false" && "$winmenu" == "false" && "$icons" == "0" && "$panel_running" == "no" ]]
+  else
+    # Expect: menu=true, winmenu=true, icons=2, panel_running=yes
+    [[ "$menu" == "true" && "$winmenu" == "true" && "$icons" == "2" && "$panel_running" == "yes" ]]
+  fi
+}
+
+# Read-only check used by toolbar_api.py after an apply: exit 0 if the
+# session currently matches the wanted mode.
+check_mode() {
+  local want="$1"
+  local menu winmenu icons panel_running
+
+  import_xfce_env
+  read_state
+  echo "menu=$menu winmenu=$winmenu icons=$icons panel=$panel_running"
+  state_matches "$want"
+}
+
+verify_and_fix_once() {
+  local want="$1"
+  local menu winmenu icons panel_running
+
+  read_state
+
+  if [[ "$want" == "on" ]]; then
+    if ! state_matches on; then
       log "verify mismatch (menu=$menu winmenu=$winmenu icons=$icons panel=$panel_running). retry once..."
       refresh_xfconf_cache
       apply_shortcuts_on
@@ -364,8 +401,7 @@ verify_and_fix_once() {
       desktop_reload
     fi
   else
-    # Expect: menu=true, winmenu=true, icons=2, panel_running=yes
-    if [[ "$menu" != "true" || "$winmenu" != "true" || "$icons" != "2" || "$panel_running" != "yes" ]]; then
+    if ! state_matches off; then
       log "verify mismatch (menu=$menu winmenu=$winmenu icons=$icons panel=$panel_running). retry once..."
       refresh_xfconf_cache
       apply_shortcuts_off
@@ -429,8 +465,33 @@ set_mode() {
   esac
 }
 
+# Long-lived mode for toolbar_api.py: read one mode per line on stdin and
+# answer with one line "<rc> <output>". Each request runs in a subshell so
+# errors/exits behave exactly like a one-shot call.
+daemon() {
+  local m out rc
+  echo "ready"
+  while IFS= read -r m; do
+    case "$m" in
+      status) set +e; out="$( (set -e; ensure_files; status) )"; rc=$?; set -e ;;
+      on|off) set +e; out="$( (set -e; set_mode "$m") )"; rc=$?; set -e ;;
+      "check on"|"check off") set +e; out="$( (set -e; check_mode "${m#check }") )"; rc=$?; set -e ;;
+      *) echo "2 Usage: on|off|status|check on|off"; continue ;;
+    esac
+    out="${out//$'\n'/ | }"
+    echo "$rc $out"
+  done
+}
+
 case "$MODE" in
   status) ensure_files; status ;;
   on|off) set_mode "$MODE" ;;
-  *) echo "Usage: $0 on|off|status" >&2; exit 2 ;;
+  check)
+    case "${2:-}" in
+      on|off) check_mode "$2" ;;
+      *) echo "Usage: $0 check on|off" >&2; exit 2 ;;
+    esac
+    ;;
+  --daemon) daemon ;;
+  *) echo "Usage: $0 on|off|status|check on|off|--daemon" >&2; exit 2 ;;
 esac
@@ -18,20 +18,41 @@
 #   when a mode change is needed (or when force=1).
 # - HTTP 200 is returned only when both the desktop stack is running AND
 #   the requested mode was applied successfully. Otherwise 202 is returned.
+# - kiosk_mode.sh is kept running in "--daemon" mode (one mode per line on
+#   stdin) so switches don't pay the script startup cost each time.
 
 import os
+import sys
 import json
 import time
+import queue
+import select
+import signal
+import socket
 import threading
 import subprocess
-from urllib.parse import urlparse, parse_qs
+import http.client
+import xmlrpc.client
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 HOST = os.environ.get("TOOLBAR_API_HOST", "0.0.0.0")
 PORT = int(os.environ.get("TOOLBAR_API_PORT", "9001"))
+# Max concurrent request handler threads (connections beyond this queue).
+MAX_WORKERS = int(os.environ.get("TOOLBAR_MAX_WORKERS", "16"))
+# A connection that doesn't send its request within this time is dropped,
+# so silent clients can't pin a pool worker.
+REQUEST_TIMEOUT_SEC = float(os.environ.get("TOOLBAR_REQUEST_TIMEOUT_SEC", "5"))
 
 SUPERVISORCTL = os.environ.get("SUPERVISORCTL", "supervisorctl")
 
+# supervisord XML-RPC socket (see [unix_http_server] in supervisord.conf).
+# If present we talk to supervisord directly instead of exec'ing supervisorctl.
+SUPERVISOR_SOCK = os.environ.get("SUPERVISOR_SOCK", "/tmp/supervisor.sock")
+SUPERVISOR_RPC_TIMEOUT_SEC = float(os.environ.get("SUPERVISOR_RPC_TIMEOUT_SEC", "15"))
+
 # Services controlled by supervisor.
 # For XFCE we typically use ONE service: "xfce".
 WM_SERVICE = os.environ.get("WM_SERVICE", "xfce").strip() or "xfce"
@@ -41,16 +62,42 @@ DESKTOP_SERVICE = os.environ.get("DESKTOP_SERVICE", "none").strip()
 # This script owns all kiosk behavior. Toolbar API stays generic.
 KIOSK_SCRIPT = os.environ.get("KIOSK_SCRIPT", "/data/conf/scripts/kiosk_mode.sh")
 
+# Keep one "kiosk_mode.sh --daemon" process alive and pipe modes to it instead
+# of starting the script per switch. Falls back to one-shot runs if the script
+# doesn't support it.
+KIOSK_DAEMON = os.environ.get("KIOSK_DAEMON", "1").strip().lower() not in ("0", "false", "no", "off")
+KIOSK_TIMEOUT_SEC = float(os.environ.get("KIOSK_TIMEOUT_SEC", "20"))
+
 WAIT_MAX_SEC = float(os.environ.get("DESKTOP_WAIT_MAX_SEC", "8.0"))
-WAIT_POLL_SEC = float(os.environ.get("DESKTOP_WAIT_POLL_SEC", "0.2"))
+WAIT_POLL_SEC = float(os.environ.get("DESKTOP_WAIT_POLL_SEC", "0.2"))  # max poll interval (backs off from 25ms)
 
-# Extra time to let XFCE/WM apply kiosk changes AFTER kiosk_mode.sh returns.
+# Max time to let XFCE/WM apply kiosk changes AFTER kiosk_mode.sh returns.
+# We poll for the applied state and return as soon as it is visible.
 MODE_APPLY_DELAY_SEC = float(os.environ.get("MODE_APPLY_DELAY_SEC", "0.8"))
+MODE_APPLY_POLL_SEC = float(os.environ.get("MODE_APPLY_POLL_SEC", "0.05"))
+KIOSK_READY_CMD = os.environ.get("KIOSK_READY_CMD", "").strip()  # if set, polled (mode passed as $1) instead of "kiosk_mode.sh check"
 
 # Optional: wait until X is responding before applying kiosk changes.
 X_READY_MAX_SEC = float(os.environ.get("X_READY_MAX_SEC", "6.0"))
-X_READY_POLL_SEC = float(os.environ.get("X_READY_POLL_SEC", "0.2"))
+X_READY_POLL_SEC = float(os.environ.get("X_READY_POLL_SEC", "0.2"))  # max poll interval (backs off from 25ms)
 X_READY_CMD = os.environ.get("X_READY_CMD", "").strip()  # if set, runs this instead of default probes
+# Once X answered a probe, skip probing again for this long. The X server is
+# its own supervisor program (xvfb), so WM restarts don't invalidate this;
+# it is reset when X_SERVICE is restarted by us or reported not RUNNING.
+X_READY_CACHE_SEC = float(os.environ.get("X_READY_CACHE_SEC", "30"))
+X_SERVICE = os.environ.get("X_SERVICE", "xvfb").strip()
+
+# Short-lived cache for supervisor status so polling clients don't hit
+# supervisord on every request. A background thread refreshes it at this
+# interval. Set to 0 to disable both.
+STATUS_TTL_SEC = float(os.environ.get("TOOLBAR_STATUS_TTL_SEC", "1.0"))
+# The refresher only runs while status was read within this window (and only
+# when supervisord's RPC socket exists); otherwise it sleeps until needed.
+STATUS_IDLE_SEC = float(os.environ.get("TOOLBAR_STATUS_IDLE_SEC", str(5 * STATUS_TTL_SEC)))
+
+# How long a /kiosk or /show call waits for an in-flight switch before
+# answering 202 "switch_in_progress".
+SWITCH_WAIT_SEC = float(os.environ.get("TOOLBAR_SWITCH_WAIT_SEC", "5.0"))
 
 # ============================
 # Client logging (browser info)
@@ -60,17 +107,35 @@ LOG_CLIENT = os.environ.get("TOOLBAR_LOG_CLIENT", "1").strip().lower() not in ("
 LOG_CLIENT_TTL_SEC = float(os.environ.get("TOOLBAR_LOG_CLIENT_TTL_SEC", "120"))
 LOG_CLIENT_MAX_UA = int(os.environ.get("TOOLBAR_LOG_CLIENT_MAX_UA", "220"))
 LOG_CLIENT_MAX_REF = int(os.environ.get("TOOLBAR_LOG_CLIENT_MAX_REF", "300"))
+LOG_CLIENT_MAX_SEEN = int(os.environ.get("TOOLBAR_LOG_CLIENT_MAX_SEEN", "2000"))
 
 _seen_lock = threading.Lock()
-_seen_clients = {}  # key -> last_ts
+_seen_clients = OrderedDict()  # key -> last_ts, least recently logged first
+
+_log_q = queue.SimpleQueue()  # formatted log lines for _log_writer
+_log_writer_running = False
+
+_status_lock = threading.Lock()
+_status_cache = (0.0, {})  # (fetched_ts, status_map)
+_status_wake = threading.Event()  # wakes the background refresher early
+_status_refresher_running = False
+_status_demand_ts = 0.0  # last time a caller read the cached status
 
-_switch_lock = threading.Lock()
 _last_switch_ts = 0.0
 
 # Mode tracking (best-effort). Prevents repeated re-apply flicker.
 _current_mode = "unknown"  # "on" or "off" once applied
 _last_apply_ts = 0.0
 
+_x_ready_ts = 0.0  # last successful wait_x_ready probe
+
+_kiosk_script_ok = False  # set once KIOSK_SCRIPT has been seen on disk
+
+_kiosk_lock = threading.Lock()
+_kiosk_proc = None  # running "kiosk_mode.sh --daemon", if any
+_kiosk_daemon_supported = None  # None = not probed yet
+_kiosk_pending = 0  # replies still owed by the helper for abandoned (timed out) checks
+
 
 def _desktop_service_enabled() -> bool:
     ds = (DESKTOP_SERVICE or "").strip()
@@ -95,21 +160,191 @@ def services_stop_order():
     return [WM_SERVICE]
 
 
+# Environment for child processes. Built once; subprocess only reads it.
+_BASE_ENV = {**os.environ, "DISPLAY": os.environ.get("DISPLAY", ":0")}
+
+
 def run_cmd(args, timeout=10):
-    env = os.environ.copy()
-    env.setdefault("DISPLAY", ":0")
     p = subprocess.run(
         args,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         text=True,
         timeout=timeout,
-        env=env,
+        env=_BASE_ENV,
     )
     return p.returncode, p.stdout, p.stderr
 
 
-def supervisor_status_map():
+def run_cmd_quiet(args, timeout=10):
+    # For callers that only need the exit code: no pipes, no decoding.
+    return subprocess.run(
+        args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        timeout=timeout,
+        env=_BASE_ENV,
+    ).returncode
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, sock_path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self._sock_path = sock_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self._sock_path)
+        self.sock = sock
+
+
+class _UnixTransport(xmlrpc.client.Transport):
+    def __init__(self, sock_path, timeout):
+        super().__init__()
+        self._sock_path = sock_path
+        self._timeout = timeout
+
+    def make_connection(self, host):
+        # Keep one persistent connection (xmlrpc.client reuses it between calls).
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        conn = _UnixHTTPConnection(self._sock_path, self._timeout)
+        self._connection = host, conn
+        return conn
+
+
+class _SupervisorRPC:
+    """Minimal supervisord XML-RPC client over the UNIX socket."""
+
+    def __init__(self, sock_path, timeout):
+        self.sock_path = sock_path
+        self.timeout = timeout
+        # One persistent connection per thread, so parallel start/stop
+        # calls from desktop_stack don't serialize on a shared socket.
+        self._local = threading.local()
+
+    def available(self) -> bool:
+        return bool(self.sock_path) and os.path.exists(self.sock_path)
+
+    def _get_proxy(self):
+        proxy = getattr(self._local, "proxy", None)
+        if proxy is None:
+            proxy = xmlrpc.client.ServerProxy(
+                "http://localhost/RPC2",
+                transport=_UnixTransport(self.sock_path, self.timeout),
+            )
+            self._local.proxy = proxy
+        return proxy
+
+    def call(self, method, *args):
+        try:
+            fn = self._get_proxy()
+            for part in method.split("."):
+                fn = getattr(fn, part)
+            return fn(*args)
+        except xmlrpc.client.Fault:
+            raise
+        except Exception:
+            # Drop the connection; next call reconnects.
+            self._local.proxy = None
+            raise
+
+
+_rpc = _SupervisorRPC(SUPERVISOR_SOCK, SUPERVISOR_RPC_TIMEOUT_SEC)
+
+# Used to stop services concurrently in desktop_stack.
+_stack_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="stack")
+
+
+def _invalidate_status_cache():
+    global _status_cache
+    with _status_lock:
+        # Keep the last map for snapshot readers; ts=0 forces a re-fetch.
+        _status_cache = (0.0, _status_cache[1])
+    _status_wake.set()
+
+
+def _store_status_map(m):
+    global _status_cache
+    with _status_lock:
+        _status_cache = (time.time(), m)
+
+
+def _cached_status_map(max_age=None):
+    global _status_demand_ts
+    with _status_lock:
+        ts, m = _status_cache
+
+    if max_age is None:
+        _status_demand_ts = time.time()
+        if _status_refresher_running:
+            # A snapshot from the last refresh period is current enough;
+            # don't fetch on the request path.
+            if ts > 0 and (time.time() - ts) < 2 * STATUS_TTL_SEC:
+                return dict(m)
+            # Stale: the refresher was idle. Wake it and fetch once here.
+            _status_wake.set()
+        max_age = STATUS_TTL_SEC
+
+    if max_age > 0 and (time.time() - ts) < max_age:
+        return dict(m)
+
+    m = _supervisor_status_map_raw()
+    _store_status_map(m)
+    return dict(m)
+
+
+def supervisor_status_map(max_age=None):
+    # max_age=0 forces a fresh query (used by the readiness waiters).
+    return _cached_status_map(max_age)
+
+
+def _status_refresher():
+    # Single background poller: keeps the status cache warm so request
+    # handlers never query supervisord themselves in steady state.
+    # Goes idle when nobody has asked for status recently.
+    while True:
+        _status_wake.clear()
+        if (time.time() - _status_demand_ts) > STATUS_IDLE_SEC:
+            _status_wake.wait()
+            continue
+        try:
+            _store_status_map(_supervisor_status_map_raw())
+        except Exception:
+            pass
+        _status_wake.wait(STATUS_TTL_SEC)
+
+
+def start_status_refresher():
+    global _status_refresher_running
+    if STATUS_TTL_SEC <= 0 or _status_refresher_running:
+        return
+    # Without the RPC socket every refresh would exec supervisorctl; leave
+    # it to the on-demand TTL cache instead.
+    if not _rpc.available():
+        return
+    _status_refresher_running = True
+    threading.Thread(target=_status_refresher, name="status_refresher", daemon=True).start()
+
+
+def _supervisor_status_map_raw():
+    if _rpc.available():
+        try:
+            infos = _rpc.call("supervisor.getAllProcessInfo")
+        except Exception:
+            infos = None
+        if infos is not None:
+            m = {}
+            for info in infos:
+                name = info.get("name", "")
+                group = info.get("group", name)
+                # Match supervisorctl naming ("group:name" for real groups).
+                if group and group != name:
+                    name = f"{group}:{name}"
+                m[name] = info.get("statename", "UNKNOWN")
+            return m
+
     rc, out, _err = run_cmd([SUPERVISORCTL, "status"], timeout=5)
     if rc != 0:
         return {}
@@ -144,30 +379,85 @@ def stack_running(status_map=None):
     return is_running(WM_SERVICE, status_map)
 
 
+# supervisor.xmlrpc.Faults codes that mean "already in the wanted state".
+_FAULT_ALREADY_STARTED = 60
+_FAULT_NOT_RUNNING = 70
+
+
+def _supervisor_rpc_control(method, service_name) -> bool:
+    # Returns True if handled via RPC, False if the caller should fall back
+    # to supervisorctl. Only ALREADY_STARTED / NOT_RUNNING faults count as
+    # success; other faults (BAD_NAME, SPAWN_ERROR, ...) are logged.
+    if not _rpc.available():
+        return False
+    try:
+        _rpc.call(method, service_name, True)
+    except xmlrpc.client.Fault as e:
+        if e.faultCode not in (_FAULT_ALREADY_STARTED, _FAULT_NOT_RUNNING):
+            log_line(
+                f"[{_now_iso()}] [toolbar_api] {method}({service_name}) failed: "
+                f"fault {e.faultCode} {e.faultString}"
+            )
+    except Exception:
+        return False
+    return True
+
+
 def supervisor_stop(service_name):
-    run_cmd([SUPERVISORCTL, "stop", service_name], timeout=10)
+    if not _supervisor_rpc_control("supervisor.stopProcess", service_name):
+        run_cmd_quiet([SUPERVISORCTL, "stop", service_name], timeout=10)
+    _invalidate_status_cache()
 
 
 def supervisor_start(service_name):
-    run_cmd([SUPERVISORCTL, "start", service_name], timeout=10)
+    if not _supervisor_rpc_control("supervisor.startProcess", service_name):
+        run_cmd_quiet([SUPERVISORCTL, "start", service_name], timeout=10)
+    _invalidate_status_cache()
+
+
+def _sleeper(deadline, initial=0.025, cap=0.25):
+    # Yields poll delays: exponential backoff from `initial` up to `cap`,
+    # clamped so we never sleep past `deadline`. Stops once it has passed.
+    delay = initial
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        yield min(delay, cap, remaining)
+        delay = min(delay * 2, cap)
 
 
 def wait_stack_ready(max_sec=WAIT_MAX_SEC):
-    end = time.time() + max_sec
-    while time.time() < end:
-        st = supervisor_status_map()
+    sleeper = _sleeper(time.time() + max_sec, cap=WAIT_POLL_SEC)
+    while True:
+        st = supervisor_status_map(max_age=0)
         if stack_running(st):
             return True
-        time.sleep(WAIT_POLL_SEC)
-    return False
+        delay = next(sleeper, None)
+        if delay is None:
+            return False
+        time.sleep(delay)
+
+
+def _stop_services():
+    # Stops are independent, so run them concurrently.
+    # Starts stay sequential: the desktop service expects the WM to be up.
+    services = services_stop_order()
+    if len(services) == 1:
+        supervisor_stop(services[0])
+        return
+    list(_stack_pool.map(supervisor_stop, services))
 
 
 def desktop_stack(action):
+    global _x_ready_ts
     action = (action or "").lower().strip()
+    _invalidate_status_cache()
+    if X_SERVICE and X_SERVICE in services_start_order():
+        _x_ready_ts = 0.0
 
     if action == "stop":
-        for s in services_stop_order():
-            supervisor_stop(s)
+        _stop_services()
         return True
 
     if action == "start":
@@ -176,23 +466,41 @@ def desktop_stack(action):
         return wait_stack_ready()
 
     # restart
-    for s in services_stop_order():
-        supervisor_stop(s)
+    _stop_services()
     for s in services_start_order():
         supervisor_start(s)
     return wait_stack_ready()
 
 
+def _x_ready_cached() -> bool:
+    if X_READY_CACHE_SEC <= 0 or (time.time() - _x_ready_ts) >= X_READY_CACHE_SEC:
+        return False
+    # Unknown/absent service: trust the cache; anything else means X went away.
+    return supervisor_status_map().get(X_SERVICE, "RUNNING") == "RUNNING"
+
+
 def wait_x_ready(max_sec=X_READY_MAX_SEC):
+    global _x_ready_ts
+    if _x_ready_cached():
+        return True
+
+    ok = _probe_x_ready(max_sec)
+    _x_ready_ts = time.time() if ok else 0.0
+    return ok
+
+
+def _probe_x_ready(max_sec):
     # If user provided a custom ready command, use it.
     if X_READY_CMD:
-        end = time.time() + max_sec
-        while time.time() < end:
-            rc, _out, _err = run_cmd(["/bin/sh", "-lc", X_READY_CMD], timeout=3)
+        sleeper = _sleeper(time.time() + max_sec, cap=X_READY_POLL_SEC)
+        while True:
+            rc = run_cmd_quiet(["/bin/sh", "-lc", X_READY_CMD], timeout=3)
             if rc == 0:
                 return True
-            time.sleep(X_READY_POLL_SEC)
-        return False
+            delay = next(sleeper, None)
+            if delay is None:
+                return False
+            time.sleep(delay)
 
     # Default probes (best-effort). If tools aren't installed, we treat as "can't test".
     probes = [
@@ -200,118 +508,411 @@ def wait_x_ready(max_sec=X_READY_MAX_SEC):
         ["xdpyinfo"],
     ]
 
-    end = time.time() + max_sec
-    while time.time() < end:
+    sleeper = _sleeper(time.time() + max_sec, cap=X_READY_POLL_SEC)
+    while True:
         for cmd in probes:
             try:
-                rc, _out, _err = run_cmd(cmd, timeout=3)
+                rc = run_cmd_quiet(cmd, timeout=3)
             except FileNotFoundError:
                 rc = 127
             if rc == 0:
                 return True
-        time.sleep(X_READY_POLL_SEC)
+        delay = next(sleeper, None)
+        if delay is None:
+            return False
+        time.sleep(delay)
 
-    return False
+
+def wait_mode_applied(mode: str, max_sec=MODE_APPLY_DELAY_SEC):
+    if max_sec <= 0:
+        return True
+    end = time.time() + max_sec
+
+    if KIOSK_READY_CMD:
+        cmd = ["/bin/sh", "-lc", KIOSK_READY_CMD, "kiosk_ready", mode]
+        while True:
+            try:
+                rc = run_cmd_quiet(cmd, timeout=max(0.5, end - time.time()))
+            except (FileNotFoundError, subprocess.TimeoutExpired):
+                return False
+            if rc == 0:
+                return True
+            remaining = end - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(MODE_APPLY_POLL_SEC, remaining))
+
+    # Default: poll "check" through the kiosk_mode.sh helper, which has the
+    # session's DBUS env and runs xfconf-query as the desktop user. Each
+    # check is bounded by what is left of the cap. Without the helper we
+    # can't probe, so fall back to the fixed delay.
+    while True:
+        remaining = end - time.time()
+        if remaining <= 0:
+            return False
+        res = kiosk_check(mode, timeout=remaining)
+        if res:
+            return True
+        if res is None:
+            time.sleep(max(0.0, end - time.time()))
+            return False
+        remaining = end - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(MODE_APPLY_POLL_SEC, remaining))
+
+
+def _read_line(proc, timeout):
+    # Returns one decoded line, "" on EOF, or None on timeout.
+    r, _w, _x = select.select([proc.stdout], [], [], timeout)
+    if not r:
+        return None
+    return proc.stdout.readline().decode("utf-8", "replace")
+
+
+def _kill_kiosk_daemon():
+    global _kiosk_proc, _kiosk_pending
+    p, _kiosk_proc = _kiosk_proc, None
+    _kiosk_pending = 0
+    if p is None:
+        return
+    try:
+        # The helper runs in its own session; kill the whole group so an
+        # in-flight set_mode subshell and its xfconf/xfdesktop children die too.
+        os.killpg(p.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    try:
+        p.wait(timeout=2)
+    except Exception:
+        pass
+
+
+def _kiosk_daemon():
+    global _kiosk_proc, _kiosk_daemon_supported
+    if _kiosk_proc is not None and _kiosk_proc.poll() is None:
+        return _kiosk_proc
+    _kiosk_proc = None
+
+    if not KIOSK_DAEMON or _kiosk_daemon_supported is False:
+        return None
+
+    try:
+        p = subprocess.Popen(
+            [KIOSK_SCRIPT, "--daemon"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=_BASE_ENV,
+            start_new_session=True,
+        )
+    except OSError:
+        return None
+
+    _kiosk_proc = p
+    first = _read_line(p, 5)
+    if first is None:
+        # Slow start (e.g. busy boot): fall back this time, retry next call.
+        _kill_kiosk_daemon()
+        return None
+    if first.strip() != "ready":
+        # Older kiosk_mode.sh: prints usage and exits. Remember and fall back.
+        _kill_kiosk_daemon()
+        _kiosk_daemon_supported = False
+        return None
+
+    _kiosk_daemon_supported = True
+    return p
+
+
+def _kiosk_daemon_request(line: str, timeout: float, abandon_on_timeout=False):
+    # Returns (ok, msg), or None if the daemon isn't usable (caller falls back).
+    # abandon_on_timeout: for read-only requests, leave the helper running and
+    # discard its late reply later instead of killing it.
+    global _kiosk_pending
+    p = _kiosk_daemon()
+    if p is None:
+        return None
+
+    # Discard replies to earlier abandoned requests before sending a new one.
+    while _kiosk_pending > 0:
+        if not _read_line(p, KIOSK_TIMEOUT_SEC):
+            # Hung or dead: start over with a fresh helper.
+            _kill_kiosk_daemon()
+            p = _kiosk_daemon()
+            if p is None:
+                return None
+            break
+        _kiosk_pending -= 1
+
+    try:
+        p.stdin.write(f"{line}\n".encode("utf-8"))
+        p.stdin.flush()
+    except (BrokenPipeError, OSError):
+        _kill_kiosk_daemon()
+        return None
+
+    reply = _read_line(p, timeout)
+    if reply is None:
+        if abandon_on_timeout:
+            _kiosk_pending += 1
+        else:
+            _kill_kiosk_daemon()
+        return False, "timeout"
+    if not reply:
+        # Daemon died mid-request; respawned on next use.
+        _kill_kiosk_daemon()
+        return None
+
+    rc, _sep, msg = reply.strip().partition(" ")
+    return (rc == "0"), (msg.strip() or "ok")
+
+
+def kiosk_check(mode: str, timeout=KIOSK_TIMEOUT_SEC):
+    # True if kiosk_mode.sh confirms the session matches `mode`, False if not
+    # (or not within `timeout`), None if the helper isn't available.
+    with _kiosk_lock:
+        res = _kiosk_daemon_request(f"check {mode}", timeout, abandon_on_timeout=True)
+    if res is None:
+        return None
+    return bool(res[0])
 
 
 def set_kiosk_mode(mode: str):
+    global _kiosk_script_ok
     # mode: "on" or "off"
-    if not os.path.exists(KIOSK_SCRIPT):
-        return False, f"missing_script:{KIOSK_SCRIPT}"
+    # The script is seeded at container start; once seen, stop stat'ing it.
+    if not _kiosk_script_ok:
+        if not os.path.exists(KIOSK_SCRIPT):
+            return False, f"missing_script:{KIOSK_SCRIPT}"
+        _kiosk_script_ok = True
+
+    with _kiosk_lock:
+        res = _kiosk_daemon_request(mode, KIOSK_TIMEOUT_SEC)
+        if res is not None:
+            return res
 
-    rc, out, err = run_cmd([KIOSK_SCRIPT, mode], timeout=20)
+        try:
+            rc, out, err = run_cmd([KIOSK_SCRIPT, mode], timeout=KIOSK_TIMEOUT_SEC)
+        except FileNotFoundError:
+            _kiosk_script_ok = False
+            return False, f"missing_script:{KIOSK_SCRIPT}"
     ok = (rc == 0)
     msg = (out.strip() if out.strip() else err.strip())
     return ok, (msg if msg else "ok")
 
 
-def build_status_payload():
-    st = supervisor_status_map()
+class StatusPayload(dict):
+    """Status response. Holds only the dynamic fields; the static config
+    fields (_STATIC_JSON_BYTES) are appended when the response is encoded."""
+
+    __slots__ = ()
+
+
+# Config fields that never change for the life of the process, serialized once.
+_STATIC_JSON_BYTES = ('"kiosk_script":%s,"wm_service":%s,"desktop_service":%s' % (
+    json.dumps(KIOSK_SCRIPT),
+    json.dumps(WM_SERVICE),
+    json.dumps(DESKTOP_SERVICE if _desktop_service_enabled() else "none"),
+)).encode("utf-8")
+
+
+def encode_json(payload) -> bytes:
+    if isinstance(payload, StatusPayload):
+        dyn = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        if dyn == b"{}":
+            return b"{" + _STATIC_JSON_BYTES + b"}"
+        return dyn[:-1] + b"," + _STATIC_JSON_BYTES + b"}"
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+def build_status_payload(status_map=None):
+    st = status_map if status_map is not None else supervisor_status_map()
 
     svc_states = {WM_SERVICE: st.get(WM_SERVICE, "UNKNOWN")}
     if _desktop_service_enabled():
         svc_states[DESKTOP_SERVICE] = st.get(DESKTOP_SERVICE, "UNKNOWN")
 
-    return {
+    # kiosk_script / wm_service / desktop_service come from _STATIC_JSON_BYTES.
+    return StatusPayload({
         "services": svc_states,
         "running": stack_running(st),
         "last_switch_ts": _last_switch_ts,
-        "kiosk_script": KIOSK_SCRIPT,
-        "wm_service": WM_SERVICE,
-        "desktop_service": (DESKTOP_SERVICE if _desktop_service_enabled() else "none"),
         "current_mode": _current_mode,
         "last_apply_ts": _last_apply_ts,
+    })
+
+
+def build_status_payload_cached():
+    # Status for polling endpoints, served from the cached snapshot. While
+    # the refresher is active this never queries supervisord; after an idle
+    # period the first call fetches once and wakes the refresher.
+    m = supervisor_status_map()
+    with _status_lock:
+        ts = _status_cache[0]
+    payload = build_status_payload(m)
+    payload["status_age_sec"] = (round(max(0.0, time.time() - ts), 3) if ts > 0 else None)
+    return payload
+
+
+class ModeFSM:
+    """Mode switch state, shared by all request threads.
+
+    unknown -> starting -> applying -> on/off. One caller drives a switch
+    (busy=True); others wait on `cond` and reuse its result.
+    """
+
+    TRANSITIONS = {
+        "unknown": ("starting", "applying", "on", "off"),
+        "starting": ("applying", "on", "off", "unknown"),
+        "applying": ("on", "off", "unknown"),
+        "on": ("starting", "applying", "unknown"),
+        "off": ("starting", "applying", "unknown"),
     }
 
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.state = "unknown"
+        self.desired = None
+        self.busy = False
+        self.last_result = None  # (desired_mode, code, payload) of last switch
+
+    def _allowed(self, state: str) -> bool:
+        return state == self.state or state in self.TRANSITIONS.get(self.state, ())
+
+    def to(self, state: str):
+        with self.cond:
+            if not self._allowed(state):
+                raise RuntimeError(f"invalid mode transition {self.state} -> {state}")
+            self.state = state
+
+    def begin(self, desired: str):
+        # Caller must hold self.cond.
+        self.busy = True
+        self.desired = desired
+
+    def finish(self, state: str, result):
+        # Must always release waiters: runs from ensure_ready's finally.
+        with self.cond:
+            try:
+                if not self._allowed(state):
+                    log_line(f"[{_now_iso()}] [toolbar_api] invalid mode transition {self.state} -> {state}")
+                self.state = state
+            finally:
+                self.busy = False
+                self.last_result = result
+                self.cond.notify_all()
 
-def ensure_ready(force: bool, want_kiosk: bool):
-    global _last_switch_ts, _current_mode, _last_apply_ts
 
-    if not _switch_lock.acquire(blocking=False):
-        payload = build_status_payload()
-        payload.update({
-            "ok": False,
-            "busy": True,
-            "changed": False,
-            "message": "switch_in_progress",
-        })
-        return 202, payload
+_mode_fsm = ModeFSM()
+
 
+def ensure_ready(force: bool, want_kiosk: bool):
+    desired_mode = "on" if want_kiosk else "off"
+
+    with _mode_fsm.cond:
+        if _mode_fsm.busy:
+            inflight = _mode_fsm.desired
+            _mode_fsm.cond.wait_for(lambda: not _mode_fsm.busy, timeout=SWITCH_WAIT_SEC)
+
+            if _mode_fsm.busy:
+                payload = build_status_payload_cached()
+                payload.update({
+                    "ok": False,
+                    "busy": True,
+                    "changed": False,
+                    "mode_state": _mode_fsm.state,
+                    "message": "switch_in_progress",
+                })
+                return 202, payload
+
+            # The switch we waited on did what we wanted: share its result
+            # instead of running kiosk_mode.sh again.
+            res = _mode_fsm.last_result
+            if not force and inflight == desired_mode and res and res[0] == desired_mode:
+                return res[1], StatusPayload(res[2])
+
+        _mode_fsm.begin(desired_mode)
+
+    final_state = "unknown"
+    result = None
     try:
-        desired_mode = "on" if want_kiosk else "off"
+        code, payload = _drive_mode_switch(force, desired_mode)
+        final_state = _current_mode
+        payload["mode_state"] = final_state
+        result = (desired_mode, code, payload)
+        return code, payload
+    finally:
+        _mode_fsm.finish(final_state, result)
 
-        st = supervisor_status_map()
+
+def _drive_mode_switch(force: bool, desired_mode: str):
+    global _last_switch_ts, _current_mode, _last_apply_ts
+
+    # One status fetch per request; threaded through to the payload.
+    st = supervisor_status_map()
+    running = stack_running(st)
+
+    if not force and not running:
+        # The cached view may be stale; confirm before starting anything.
+        st = supervisor_status_map(max_age=0)
         running = stack_running(st)
 
-        restarted = False
-        if force or not running:
-            ok_stack = desktop_stack("restart" if force else "start")
-            restarted = True
-            _last_switch_ts = time.time()
-
-            # If supervisor says "RUNNING", still give X a chance to come up.
-            # If this probe fails, we keep going (best-effort).
-            if ok_stack:
-                wait_x_ready()
-
-        # Decide whether we actually need to (re)apply kiosk settings.
-        # This prevents repeated XFCE flicker if clients poll /kiosk or /show.
-        apply_needed = force or restarted or (_current_mode != desired_mode)
-
-        ok_mode = True
-        msg_mode = "skipped"
-        if apply_needed:
-            ok_mode, msg_mode = set_kiosk_mode(desired_mode)
-            if ok_mode:
-                _current_mode = desired_mode
-                _last_apply_ts = time.time()
-                if MODE_APPLY_DELAY_SEC > 0:
-                    time.sleep(MODE_APPLY_DELAY_SEC)
-
-        payload = build_status_payload()
-        running_now = bool(payload.get("running"))
-
-        # Consider it OK only if:
-        # - stack is running, and
-        # - kiosk_mode.sh succeeded (or was skipped because already applied), and
-        # - our current_mode matches the desired_mode
-        ok_all = running_now and bool(ok_mode) and (_current_mode == desired_mode)
-
-        payload.update({
-            "ok": ok_all,
-            "busy": False,
-            "changed": restarted,
-            "requested_mode": desired_mode,
-            "applied": bool(apply_needed),
-            "mode_ok": bool(ok_mode),
-            "mode_msg": msg_mode,
-            "message": "ready" if ok_all else ("starting" if not running_now else "applying"),
-        })
-
-        return (200 if ok_all else 202), payload
+    restarted = False
+    services_changed = False
+    if force or not running:
+        _mode_fsm.to("starting")
+        ok_stack = desktop_stack("restart" if force else "start")
+        restarted = True
+        _last_switch_ts = time.time()
+
+        # Only re-fetch when we actually touched the stack. A "start" that
+        # supervisor no-ops (already RUNNING) leaves the session untouched.
+        before = st
+        st = supervisor_status_map()
+        services_changed = (not before) or any(
+            before.get(s) != st.get(s) for s in services_start_order()
+        )
 
-    finally:
-        _switch_lock.release()
+        # If supervisor says "RUNNING", still give X a chance to come up.
+        # If this probe fails, we keep going (best-effort).
+        if ok_stack:
+            wait_x_ready()
+
+    # Decide whether we actually need to (re)apply kiosk settings.
+    # This prevents repeated XFCE flicker if clients poll /kiosk or /show.
+    apply_needed = force or services_changed or (_current_mode != desired_mode)
+
+    ok_mode = True
+    msg_mode = "skipped"
+    if apply_needed:
+        _mode_fsm.to("applying")
+        ok_mode, msg_mode = set_kiosk_mode(desired_mode)
+        if ok_mode:
+            _current_mode = desired_mode
+            _last_apply_ts = time.time()
+            wait_mode_applied(desired_mode)
+
+    payload = build_status_payload(st)
+    running_now = bool(payload.get("running"))
+
+    # Consider it OK only if:
+    # - stack is running, and
+    # - kiosk_mode.sh succeeded (or was skipped because already applied), and
+    # - our current_mode matches the desired_mode
+    ok_all = running_now and bool(ok_mode) and (_current_mode == desired_mode)
+
+    payload.update({
+        "ok": ok_all,
+        "busy": False,
+        "changed": restarted,
+        "requested_mode": desired_mode,
+        "applied": bool(apply_needed),
+        "mode_ok": bool(ok_mode),
+        "mode_msg": msg_mode,
+        "message": "ready" if ok_all else ("starting" if not running_now else "applying"),
+    })
+
+    return (200 if ok_all else 202), payload
 
 
 def _clip(s: str, n: int) -> str:
@@ -327,19 +928,120 @@ def _now_iso() -> str:
     return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
 
 
+def _log_writer():
+    # Single consumer: request threads never block on stdout.
+    while True:
+        line = _log_q.get()
+        try:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        except Exception:
+            pass
+
+
+def start_log_writer():
+    global _log_writer_running
+    if _log_writer_running:
+        return
+    _log_writer_running = True
+    threading.Thread(target=_log_writer, name="log_writer", daemon=True).start()
+
+
+def log_line(msg: str):
+    if _log_writer_running:
+        _log_q.put(msg + "\n")
+    else:
+        print(msg, flush=True)
+
+
+def _query_force(query: str) -> bool:
+    # Only "force" is ever read, so skip parse_qs and scan for it directly.
+    if "force=" not in query:
+        return False
+    for part in query.split("&"):
+        if part.startswith("force="):
+            return part[6:].strip() == "1"
+    return False
+
+
+def _mode_handler(path, force):
+    payload = build_status_payload_cached()
+    payload.update({"ok": True})
+    return 200, payload
+
+
+def _kiosk_handler(path, force):
+    return ensure_ready(force=force, want_kiosk=True)
+
+
+def _show_handler(path, force):
+    return ensure_ready(force=force, want_kiosk=False)
+
+
+def _restart_handler(path, force):
+    desktop_stack("restart")
+    payload = build_status_payload()
+    payload.update({"ok": True, "message": "restarted"})
+    return 200, payload
+
+
+def _not_found(path, force):
+    return 404, {"ok": False, "error": "not_found", "path": path}
+
+
+_ROUTES = {
+    "/": _mode_handler,
+    "/debug": _mode_handler,
+    "/mode": _mode_handler,
+    "/kiosk": _kiosk_handler,
+    "/hide": _kiosk_handler,
+    "/show": _show_handler,
+    "/desktop": _show_handler,
+    "/restart": _restart_handler,
+    "/reset": _restart_handler,
+}
+
+
+# Static response header block; only status line, date and length vary.
+# Every response closes the connection (nginx doesn't reuse upstream ones).
+_HDR_TEMPLATE = (
+    "{proto} {code} {reason}\r\n"
+    "Server: {server}\r\n"
+    "Date: {date}\r\n"
+    "Content-Type: application/json; charset=utf-8\r\n"
+    "Cache-Control: no-store, no-cache, must-revalidate, max-age=0\r\n"
+    "Pragma: no-cache\r\n"
+    "Content-Length: {length}\r\n"
+    "Connection: close\r\n"
+    "\r\n"
+)
+
+
+def _status_reason(code: int) -> str:
+    try:
+        return HTTPStatus(code).phrase
+    except ValueError:
+        return ""
+
+
 class Handler(BaseHTTPRequestHandler):
     server_version = "toolbar_api/kiosk-script-1.2+clientlog"
+    timeout = REQUEST_TIMEOUT_SEC
 
     def _send_json(self, code: int, payload: dict):
-        body = json.dumps(payload, indent=2).encode("utf-8")
+        body = encode_json(payload)
+        header = _HDR_TEMPLATE.format(
+            proto=self.protocol_version,
+            code=code,
+            reason=_status_reason(code),
+            server=self.version_string(),
+            date=self.date_time_string(),
+            length=len(body),
+        ).encode("latin-1")
+        self.close_connection = True
         try:
-            self.send_response(code)
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.send_header("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0")
-            self.send_header("Pragma", "no-cache")
-            self.send_header("Content-Length", str(len(body)))
-            self.end_headers()
-            self.wfile.write(body)
+            # One write for headers + body.
+            self.wfile.write(header + body)
         except (BrokenPipeError, ConnectionResetError):
             return
 
@@ -360,12 +1062,10 @@ class Handler(BaseHTTPRequestHandler):
         if not LOG_CLIENT:
             return
 
+        # Only ip + user-agent are needed for the dedup check; the rest is
+        # gathered below once we know this client will actually be logged.
         ip = self._client_ip()
         ua = self.headers.get("User-Agent", "")
-        ref = self.headers.get("Referer", "") or self.headers.get("Referrer", "")
-        origin = self.headers.get("Origin", "")
-        lang = self.headers.get("Accept-Language", "")
-        host = self.headers.get("Host", "")
 
         key = f"{ip}|{ua}"
         now = time.time()
@@ -375,69 +1075,68 @@ class Handler(BaseHTTPRequestHandler):
             if (now - last) < LOG_CLIENT_TTL_SEC:
                 return
             _seen_clients[key] = now
+            _seen_clients.move_to_end(key)
+
+            # LRU bound: evict oldest entries, O(1) each.
+            while len(_seen_clients) > LOG_CLIENT_MAX_SEEN:
+                _seen_clients.popitem(last=False)
 
-            # opportunistic cleanup to keep dict bounded
-            if len(_seen_clients) > 2000:
-                cutoff = now - LOG_CLIENT_TTL_SEC
-                for k, ts in list(_seen_clients.items()):
-                    if ts < cutoff:
-                        _seen_clients.pop(k, None)
+        h = self.headers
+        ref = h.get("Referer", "") or h.get("Referrer", "")
+        origin = h.get("Origin", "")
+        lang = h.get("Accept-Language", "")
+        host = h.get("Host", "")
 
-        print(
+        log_line(
             f"[{_now_iso()}] [toolbar_api] client "
             f"ip={ip} path={path} force={1 if force_flag else 0} "
             f"host={_clip(host, 120)!r} "
             f"ua={_clip(ua, LOG_CLIENT_MAX_UA)!r} "
             f"lang={_clip(lang, 120)!r} "
             f"origin={_clip(origin, 200)!r} "
-            f"referer={_clip(ref, LOG_CLIENT_MAX_REF)!r}",
-            flush=True
+            f"referer={_clip(ref, LOG_CLIENT_MAX_REF)!r}"
         )
 
     def do_GET(self):
         try:
-            u = urlparse(self.path)
-            path = u.path
-            q = parse_qs(u.query)
-            force = (q.get("force", ["0"])[0].strip() == "1")
+            path, _sep, query = self.path.partition("?")
+            force = _query_force(query)
 
             # Log browser/client info once per TTL window (prevents /mode spam)
             self._maybe_log_client(path=path, force_flag=force)
 
-            if path in ("/", "/debug", "/mode"):
-                payload = build_status_payload()
-                payload.update({"ok": True})
-                self._send_json(200, payload)
-                return
+            code, payload = _ROUTES.get(path, _not_found)(path, force)
+            self._send_json(code, payload)
 
-            if path in ("/kiosk", "/hide"):
-                code, payload = ensure_ready(force=force, want_kiosk=True)
-                self._send_json(code, payload)
-                return
+        except Exception as e:
+            payload = {"ok": False, "error": "exception", "message": str(e)}
+            self._send_json(500, payload)
 
-            if path in ("/show", "/desktop"):
-                code, payload = ensure_ready(force=force, want_kiosk=False)
-                self._send_json(code, payload)
-                return
 
-            if path in ("/restart", "/reset"):
-                desktop_stack("restart")
-                payload = build_status_payload()
-                payload.update({"ok": True, "message": "restarted"})
-                self._send_json(200, payload)
-                return
+class PooledHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer that reuses a fixed pool of handler threads
+    instead of starting one thread per connection. Handlers close the
+    connection after each response, so a worker is held for one request."""
 
-            payload = {"ok": False, "error": "not_found", "path": path}
-            self._send_json(404, payload)
+    daemon_threads = True
 
-        except Exception as e:
-            payload = {"ok": False, "error": "exception", "message": str(e)}
-            self._send_json(500, payload)
+    def __init__(self, server_address, handler_class, max_workers=MAX_WORKERS):
+        super().__init__(server_address, handler_class)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="http")
+
+    def process_request(self, request, client_address):
+        # process_request_thread handles errors and closes the request.
+        self._pool.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
 
 
 def main():
-    httpd = ThreadingHTTPServer((HOST, PORT), Handler)
-    httpd.daemon_threads = True
+    start_log_writer()
+    start_status_refresher()
+    httpd = PooledHTTPServer((HOST, PORT), Handler)
     httpd.serve_forever()
 
 